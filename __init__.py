@@ -1,17 +1,55 @@
 import json
-import traceback
-from copy import copy, deepcopy
+from collections import deque
+from functools import wraps
+
+# numba is slow to import, so the compiled kernels are loaded the first time
+# a graph uses them; False records that the import failed
+_kernels = None
 
 class DAGValidationError(Exception):
     pass
 
+def _csr_kernels():
+    """ Imports the compiled CSR kernels on first use.
+    Returns None if numpy or numba cannot be imported.
+    """
+
+    global _kernels
+    if _kernels is None:
+        try:
+            from . import _kahn_numba
+        except ImportError:
+            _kernels = False
+        else:
+            _kernels = _kahn_numba
+    return _kernels or None
+
+def _cached(method):
+    """ Caches the result of a DAG method until the graph is next modified. """
+
+    name = method.__name__
+
+    @wraps(method)
+    def wrapper(self):
+        version, result = self._cache.get(name, (None, None))
+        if version != self._version:
+            result = method(self)
+            self._cache[name] = (self._version, result)
+        return result
+    return wrapper
+
 class DAG(object):
     """ Directed acyclic graph implementation. """
 
     def __init__(self):
         """ Construct a new DAG with no nodes or edges. """
         self.graph = {}
+        self.rgraph = {}
+        self._version = 0
+        self._cache = {}
+        self._frozen = None
         self.levels = {}
+        self.level_nodes = {}
         self.max_level = -1
 
     def add_node(self, node_name):
@@ -21,6 +59,14 @@ class DAG(object):
             raise ValueError("node %s already exists" % node_name)
 
         self.graph[node_name] = set()
+        self.rgraph[node_name] = set()
+        self._version += 1
+
+        if self.levels:
+            # a new node is a root until an edge points at it
+            self.levels[node_name] = 0
+            self.level_nodes.setdefault(0, []).append(node_name)
+            self.max_level = max(self.max_level, 0)
 
     def add_node_if_not_exists(self, node_name):
         try:
@@ -31,14 +77,30 @@ class DAG(object):
     def delete_node(self, node_name):
         """ Deletes this node and all edges referencing it. """
 
-        if node_name not in graph:
+        if node_name not in self.graph:
             raise KeyError('node %s does not exist' % node_name)
 
-        self.graph.pop(node_name)
+        for node in self.rgraph.pop(node_name):
+            self.graph[node].remove(node_name)
+
+        children = self.graph.pop(node_name)
+        for node in children:
+            self.rgraph[node].remove(node_name)
+        self._version += 1
+
+        if node_name not in self.levels:
+            return
+
+        if children:
+            # descendants may have been reached through this node
+            self.build_levels()
+            return
 
-        for node, edges in self.graph.items():
-            if node_name in edges:
-                edges.remove(node_name)
+        level = self.levels.pop(node_name)
+        self.level_nodes[level].remove(node_name)
+        if not self.level_nodes[level]:
+            del self.level_nodes[level]
+            self.max_level = max(self.level_nodes) if self.level_nodes else -1
 
     def delete_node_if_exists(self, node_name):
         try:
@@ -48,24 +110,38 @@ class DAG(object):
 
     def add_edge(self, ind_node, dep_node):
         """ Add an edge (dependency) between the specified nodes. """
-        try:
-            if ind_node not in self.graph or dep_node not in self.graph:
-                raise KeyError('one or more nodes do not exist in graph')
 
-            if dep_node in self.graph[ind_node]:
-                return
+        if ind_node not in self.graph or dep_node not in self.graph:
+            raise KeyError('one or more nodes do not exist in graph')
+
+        if dep_node in self.graph[ind_node]:
+            return
+
+        if self._reachable(dep_node, ind_node):
+            raise DAGValidationError('edge %s -> %s would create a cycle'
+                                     % (ind_node, dep_node))
 
-            self.graph[ind_node].add(dep_node)
-            is_valid, message = self.validate()
+        self.graph[ind_node].add(dep_node)
+        self.rgraph[dep_node].add(ind_node)
+        self._version += 1
+        self._update_levels(ind_node, dep_node)
 
-            if not is_valid:
-                self.graph[ind_node].remove(dep_node)
-                print(message)
+    def _reachable(self, start, target):
+        """ Returns whether target can be reached from start. """
 
-        except DAGValidationError:
-            self.graph[ind_node].remove(dep_node)
-            print(traceback.print_exc())
+        if start == target:
+            return True
 
+        seen = set([start])
+        stack = [start]
+        while stack:
+            for node in self.graph[stack.pop()]:
+                if node == target:
+                    return True
+                if node not in seen:
+                    seen.add(node)
+                    stack.append(node)
+        return False
 
     def delete_edge(self, ind_node, dep_node):
         """ Delete an edge from the graph. """
@@ -74,28 +150,40 @@ class DAG(object):
             raise KeyError('this edge does not exist in graph')
 
         self.graph[ind_node].remove(dep_node)
+        self.rgraph[dep_node].remove(ind_node)
+        self._version += 1
+
+        if not self.levels:
+            return
+
+        # dep_node and its descendants only get deeper if this edge was the
+        # last one reaching dep_node from the level above
+        level = self.levels[dep_node] - 1
+        if self.levels[ind_node] == level and not any(
+                self.levels[node] == level for node in self.rgraph[dep_node]):
+            self.build_levels()
 
     def predecessors(self, node):
         """ Returns a list of all predecessors of the given node """
         
-        return [key for key in self.graph if node in self.graph[key]]
+        return list(self.rgraph.get(node, ()))
 
     def upstream(self, node):
         """ Returns path from root to node
         """
         if node not in self.graph:
             return []
-            
-        depth = self.depth(node)
-        path = [node]
-        while depth > -1:
-            depth -= 1
-            possible_parents = self.get_nodes_at_depth(depth)
 
-            for possible_parent in possible_parents:
-                if path[-1] in self.graph[possible_parent]:
-                    path.append(possible_parent)
-                    continue
+        path = [node]
+        while self.rgraph[node]:
+            # follow a parent one level up when levels are built, so the
+            # path has depth(node) + 1 nodes
+            parents = self.rgraph[node]
+            level = self.levels.get(node, 0) - 1
+            node = next((parent for parent in parents
+                         if self.levels.get(parent) == level),
+                        next(iter(parents)))
+            path.append(node)
 
         return path
 
@@ -111,27 +199,38 @@ class DAG(object):
         of the given node in the dependency graph, in
         topological order."""
         
-        nodes = [node]
+        if node not in self.graph:
+            raise KeyError('node %s is not in graph' % node)
+
+        if self._is_frozen():
+            indptr, indices, id_of, name_of = self._to_csr()
+            ids = _csr_kernels().downstream(
+                indptr, indices, self._topological_ids(), id_of[node])
+            return [name_of[i] for i in ids]
+
+        nodes = deque([node])
         nodes_seen = set()
-        i = 0
-        while i < len(nodes):
-            downstreams = self.downstream(nodes[i])
-            for downstream_node in downstreams:
+        while nodes:
+            for downstream_node in self.graph[nodes.popleft()]:
                 if downstream_node not in nodes_seen:
                     nodes_seen.add(downstream_node)
                     nodes.append(downstream_node)
-            i += 1
-        return filter(lambda node: node in nodes_seen, self.topological_sort())
+        return self._kahn(nodes_seen)
 
     def root(self):
         """ Return a list of all leaves (nodes with no downstreams) """
         
-        return [key for key in self.graph if not self.graph[key]]
+        return list(self._leaves())
 
     def all_leaves(self):
         """ Return a list of all leaves (nodes with no downstreams) """
         
-        return [key for key in self.graph if not self.graph[key]]
+        return list(self._leaves())
+
+    @_cached
+    def _leaves(self):
+        """ Returns a frozenset of all leaves. """
+        return frozenset(key for key in self.graph if not self.graph[key])
 
     def from_dict(self, graph_dict):
         """ Reset the graph and build it from the passed dictionary.
@@ -140,16 +239,19 @@ class DAG(object):
 
         self.reset_graph()
         for new_node in graph_dict.keys():
-            self.add_node(new_node)
+            self.add_node_if_not_exists(new_node)
             for node in graph_dict[new_node]:
-                self.add_node(node)
+                self.add_node_if_not_exists(node)
 
         for ind_node, dep_nodes in graph_dict.items():
             if not isinstance(dep_nodes, list):
                 raise TypeError('dict values must be lists')
             for dep_node in dep_nodes:
-                self.add_edge(ind_node, dep_node)
+                self.graph[ind_node].add(dep_node)
+                self.rgraph[dep_node].add(ind_node)
 
+        self._version += 1
+        self._validate_or_reset()
         self.build_levels()
 
     def from_json(self, js, start=None):
@@ -177,8 +279,11 @@ class DAG(object):
             for parent, child in self.json2edges(start_node, js[start_node]):
                 self.add_node_if_not_exists(parent)
                 self.add_node_if_not_exists(child)
-                self.add_edge(parent, child)
+                self.graph[parent].add(child)
+                self.rgraph[child].add(parent)
 
+        self._version += 1
+        self._validate_or_reset()
         self.build_levels()
 
     def json2edges(self, parent, children):
@@ -194,90 +299,197 @@ class DAG(object):
     def reset_graph(self):
         """ Restore the graph to an empty state. """
         self.graph = {}
+        self.rgraph = {}
+        self.levels = {}
+        self.level_nodes = {}
+        self.max_level = -1
+        self._version += 1
 
 
     def ind_nodes(self):
         """ Returns a list of all nodes in the graph with no dependencies. """
         
-        all_nodes, dependent_nodes = set(self.graph.keys()), set()
-        for downstream_nodes in self.graph.values():
-            [dependent_nodes.add(node) for node in downstream_nodes]
-        return list(all_nodes - dependent_nodes)
+        return list(self._ind_nodes())
+
+    @_cached
+    def _ind_nodes(self):
+        """ Returns a frozenset of all nodes with no dependencies. """
+        dependent_nodes = set().union(*self.graph.values())
+        return frozenset(self.graph.keys() - dependent_nodes)
 
 
     def all_paths(self, start=None):
         paths = []
         
         if start is None:
-            start_nodes = self.ind_nodes()
+            start_nodes = self._ind_nodes()
         else:
             start_nodes = [start]
 
-        all_leaves = self.all_leaves()
+        all_leaves = self._leaves()
 
         for start in start_nodes:
-            stack = [(start, [start])]
+            # path and on_path are shared by the whole walk: a node is pushed
+            # when it is entered and popped once its children are exhausted
+            path, on_path = [start], set([start])
+            stack = [iter(self.graph[start])]
             while stack:
-                (vertex, path) = stack.pop()
-                for next in self.graph[vertex] - set(path):
+                for next in stack[-1]:
+                    if next in on_path:
+                        continue
                     if next in all_leaves:
                         paths.append(path + [next])
                     else:
-                        stack.append((next, path + [next]))
+                        path.append(next)
+                        on_path.add(next)
+                        stack.append(iter(self.graph[next]))
+                        break
+                else:
+                    stack.pop()
+                    on_path.discard(path.pop())
         return paths
 
     def validate(self):
         """ Returns (Boolean, message) of whether DAG is valid. """
 
-        if len(self.ind_nodes()) == 0:
+        if len(self._ind_nodes()) == 0:
             return (False, 'no independent nodes detected')
-        try:
-            self.topological_sort()
-
-        except ValueError:
-            return (False, 'failed topological sort')
+        if self._has_cycle():
+            return (False, 'graph is not acyclic')
         return (True, 'valid')
 
+    def _has_cycle(self):
+        """ Returns whether the graph contains a cycle, stopping at the
+        first back edge found by an iterative depth-first search.
+        """
 
-    def _dependencies(self, target_node, graph):
-        """ Returns a list of all nodes from incoming edges. """
-        if graph is None:
-            raise Exception("Graph given is None")
-        result = set()
-        for node, outgoing_nodes in graph.items():
-            if target_node in outgoing_nodes:
-                result.add(node)
-        return list(result)
+        WHITE, GRAY, BLACK = 0, 1, 2
+        color = dict.fromkeys(self.graph, WHITE)
+        for start in self.graph:
+            if color[start] != WHITE:
+                continue
 
+            color[start] = GRAY
+            stack = [(start, iter(self.graph[start]))]
+            while stack:
+                node, children = stack[-1]
+                for child in children:
+                    if color[child] == GRAY:
+                        return True
+                    if color[child] == WHITE:
+                        color[child] = GRAY
+                        stack.append((child, iter(self.graph[child])))
+                        break
+                else:
+                    color[node] = BLACK
+                    stack.pop()
+        return False
+
+    def _validate_or_reset(self):
+        """ Validates a graph built in bulk, emptying it if it is invalid. """
+
+        is_valid, message = self.validate()
+        if not is_valid:
+            self.reset_graph()
+            raise DAGValidationError(message)
 
     def topological_sort(self):
         """ Returns a topological ordering of the DAG.
         Raises an error if this is not possible (graph is not valid).
         """
         
-        graph = deepcopy(self.graph)
+        return list(self._topological_order())
 
-        l = []
-        q = deepcopy(self.ind_nodes())
-        while len(q) != 0:
-            n = q.pop(0)
-            l.append(n)
-            iter_nodes = deepcopy(graph[n])
-            for m in iter_nodes:
-                graph[n].remove(m)
-                if len(self._dependencies(m, graph)) == 0:
-                    q.append(m)
+    @_cached
+    def _topological_order(self):
+        """ Returns a topological ordering of the DAG as a tuple. """
+        if self._is_frozen():
+            name_of = self._to_csr()[3]
+            return tuple(name_of[i] for i in self._topological_ids())
 
-        if len(l) != len(graph.keys()):
+        l = self._kahn(self.graph)
+        if len(l) != len(self.graph):
+            raise ValueError('graph is not acyclic')
+        return tuple(l)
+
+    @_cached
+    def _topological_ids(self):
+        """ Returns a topological ordering of the CSR node ids. """
+        indptr, indices, _, name_of = self._to_csr()
+        ids = _csr_kernels().kahn(indptr, indices, len(name_of))
+        if len(ids) != len(name_of):
             raise ValueError('graph is not acyclic')
+        return ids
+
+    def _kahn(self, nodes):
+        """ Returns a topological ordering of the subgraph induced by nodes.
+        Nodes on a cycle are left out of the result.
+        """
+
+        indegree = dict.fromkeys(nodes, 0)
+        for node in indegree:
+            for child in self.graph[node]:
+                if child in indegree:
+                    indegree[child] += 1
+
+        l = []
+        q = deque(node for node, degree in indegree.items() if degree == 0)
+        while q:
+            n = q.popleft()
+            l.append(n)
+            for m in self.graph[n]:
+                if m in indegree:
+                    indegree[m] -= 1
+                    if indegree[m] == 0:
+                        q.append(m)
         return l
 
+    def freeze(self):
+        """ Builds a CSR (compressed sparse row) copy of the graph that
+        topological_sort and all_downstreams run on with compiled kernels.
+        The graph is thawed again by the next modification.
+        Requires numpy and numba. The first call in a process compiles the
+        kernels (or loads them from numba's cache), which takes longer than
+        sorting all but very large graphs in Python.
+        """
+
+        if _csr_kernels() is None:
+            raise ImportError('freeze() requires numpy and numba')
+
+        self._topological_ids()
+        self._frozen = self._version
+
+    def _is_frozen(self):
+        return self._frozen == self._version
+
+    @_cached
+    def _to_csr(self):
+        """ Returns the graph as CSR arrays (indptr, indices) of int32 node
+        ids, together with the id_of and name_of mappings between node names
+        and ids.
+        """
+
+        import numpy as np
+
+        name_of = list(self.graph)
+        id_of = dict((name, i) for i, name in enumerate(name_of))
+        indptr = np.zeros(len(name_of) + 1, dtype=np.int32)
+        np.cumsum([len(self.graph[name]) for name in name_of],
+                  out=indptr[1:])
+        indices = np.fromiter(
+            (id_of[child] for name in name_of for child in self.graph[name]),
+            dtype=np.int32, count=indptr[-1])
+        return (indptr, indices, id_of, name_of)
+
     def build_levels(self):
         """ Builds a dictionary with depth of each node
+        Once built, the levels are kept current by add_node, delete_node,
+        add_edge and delete_edge.
         """
 
         self.levels = {}
-        batch = set(self.ind_nodes())
+        self.level_nodes = {}
+        batch = set(self._ind_nodes())
         if len(batch) == 0:
             raise ValueError("graph doesn't have a root")
 
@@ -287,6 +499,7 @@ class DAG(object):
             node = batch.pop()
             if node not in self.levels:
                 self.levels[node] = level
+                self.level_nodes.setdefault(level, []).append(node)
                 for child in self.graph[node]:
                     if child not in self.levels:
                         next_batch.add(child)
@@ -298,11 +511,52 @@ class DAG(object):
 
         self.max_level = max(self.levels.values())
 
+    def _update_levels(self, ind_node, dep_node):
+        """ Updates the levels built by build_levels after the edge
+        ind_node -> dep_node was added, touching only the descendants whose
+        depth drops. Rebuilds the levels if the set of roots changed.
+        """
+
+        if not self.levels:
+            return
+
+        if len(self.rgraph[dep_node]) == 1:
+            # dep_node was a root
+            self.build_levels()
+            return
+
+        level = self.levels[ind_node] + 1
+        if level >= self.levels[dep_node]:
+            return
+
+        self._set_level(dep_node, level)
+        q = deque([dep_node])
+        while q:
+            n = q.popleft()
+            level = self.levels[n] + 1
+            for m in self.graph[n]:
+                if level < self.levels[m]:
+                    self._set_level(m, level)
+                    q.append(m)
+
+        self.max_level = max(self.level_nodes)
+
+    def _set_level(self, node, level):
+        """ Moves node to the given level. """
+
+        old_level = self.levels[node]
+        self.level_nodes[old_level].remove(node)
+        if not self.level_nodes[old_level]:
+            del self.level_nodes[old_level]
+
+        self.levels[node] = level
+        self.level_nodes.setdefault(level, []).append(node)
+
     def get_nodes_at_depth(self, level):
         """ Returns depth of node
         """
 
-        return [key for key, val in self.levels.items() if val==level]
+        return list(self.level_nodes.get(level, ()))
 
     def depth(self, node):
         """ Returns depth of node
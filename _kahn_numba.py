@@ -0,0 +1,60 @@
+""" Numba-compiled graph kernels over CSR adjacency arrays. """
+
+import numpy as np
+from numba import njit
+
+
+@njit(cache=True)
+def kahn(indptr, indices, n):
+    """ Returns node ids in topological order.
+    Fewer than n ids are returned if the graph is not acyclic.
+    """
+
+    indegree = np.zeros(n, dtype=np.int32)
+    for i in range(indices.shape[0]):
+        indegree[indices[i]] += 1
+
+    # every node is enqueued at most once, so the output doubles as the queue
+    order = np.empty(n, dtype=np.int32)
+    head = 0
+    tail = 0
+    for node in range(n):
+        if indegree[node] == 0:
+            order[tail] = node
+            tail += 1
+
+    while head < tail:
+        node = order[head]
+        head += 1
+        for i in range(indptr[node], indptr[node + 1]):
+            child = indices[i]
+            indegree[child] -= 1
+            if indegree[child] == 0:
+                order[tail] = child
+                tail += 1
+
+    return order[:tail]
+
+
+@njit(cache=True)
+def downstream(indptr, indices, order, start):
+    """ Returns the ids reachable from start, excluding start itself, in the
+    order they appear in order.
+    """
+
+    n = indptr.shape[0] - 1
+    seen = np.zeros(n, dtype=np.bool_)
+    stack = np.empty(n, dtype=np.int32)
+    stack[0] = start
+    top = 1
+    while top > 0:
+        top -= 1
+        node = stack[top]
+        for i in range(indptr[node], indptr[node + 1]):
+            child = indices[i]
+            if not seen[child]:
+                seen[child] = True
+                stack[top] = child
+                top += 1
+
+    return order[seen[order]]
@@ -0,0 +1,61 @@
+import random
+
+import pytest
+
+from .. import DAG, _csr_kernels
+
+# skips both when numba is missing and when it is installed but fails to
+# import, which pytest.importorskip('numba') reports as an error
+if _csr_kernels() is None:
+    pytest.skip('freeze() requires numpy and numba', allow_module_level=True)
+
+
+def random_dag(rng, size, density):
+    return dict((i, [j for j in range(i + 1, size) if rng.random() < density])
+                for i in range(size))
+
+
+def assert_topological(dag, order):
+    position = dict((node, i) for i, node in enumerate(order))
+    assert all(position[node] < position[child]
+               for node in order for child in dag.graph[node]
+               if child in position)
+
+
+def test_frozen_queries_match_unfrozen():
+    rng = random.Random(5)
+    for _ in range(50):
+        size = rng.randint(1, 40)
+        dag = DAG()
+        dag.from_dict(random_dag(rng, size, 0.15))
+        downstreams = dict((node, sorted(dag.all_downstreams(node)))
+                           for node in dag.graph)
+
+        dag.freeze()
+        order = dag.topological_sort()
+        assert sorted(order) == sorted(dag.graph)
+        assert_topological(dag, order)
+
+        for node in dag.graph:
+            frozen = dag.all_downstreams(node)
+            assert sorted(frozen) == downstreams[node]
+            assert_topological(dag, frozen)
+
+
+def test_mutation_thaws():
+    dag = DAG()
+    dag.from_dict({'a': ['b'], 'b': []})
+    dag.freeze()
+    assert dag._is_frozen()
+
+    dag.add_node('c')
+    assert not dag._is_frozen()
+    dag.add_edge('b', 'c')
+    assert dag.topological_sort() == ['a', 'b', 'c']
+    assert dag.all_downstreams('a') == ['b', 'c']
+
+
+def test_freeze_empty_graph():
+    dag = DAG()
+    dag.freeze()
+    assert dag.topological_sort() == []
@@ -0,0 +1,58 @@
+import pytest
+
+from .. import DAG, DAGValidationError
+
+
+def chain(*nodes):
+    dag = DAG()
+    for node in nodes:
+        dag.add_node(node)
+    for ind_node, dep_node in zip(nodes, nodes[1:]):
+        dag.add_edge(ind_node, dep_node)
+    return dag
+
+
+def test_add_edge_rejects_self_loop():
+    dag = chain('a', 'b')
+    with pytest.raises(DAGValidationError):
+        dag.add_edge('a', 'a')
+    assert dag.graph == {'a': set(['b']), 'b': set()}
+
+
+def test_add_edge_rejects_back_edge():
+    dag = chain('a', 'b', 'c')
+    with pytest.raises(DAGValidationError):
+        dag.add_edge('c', 'a')
+    assert dag.graph == {'a': set(['b']), 'b': set(['c']), 'c': set()}
+    assert dag.predecessors('a') == []
+
+
+def test_add_edge_missing_node():
+    dag = chain('a')
+    with pytest.raises(KeyError):
+        dag.add_edge('a', 'b')
+
+
+def test_validate_detects_cycle_below_a_root():
+    dag = chain('a', 'b', 'c')
+    dag.graph['c'].add('b')
+    assert dag.validate() == (False, 'graph is not acyclic')
+
+
+def test_from_dict_with_cycle_resets_graph():
+    dag = DAG()
+    dag.from_dict({'a': ['b'], 'b': []})
+    with pytest.raises(DAGValidationError):
+        dag.from_dict({'a': ['b'], 'b': ['c'], 'c': ['b']})
+    assert dag.graph == {}
+    assert dag.rgraph == {}
+    assert dag.levels == {}
+    assert dag.max_level == -1
+
+
+def test_all_paths_diamond_and_isolated_node():
+    dag = DAG()
+    dag.from_dict({'a': ['b', 'c'], 'b': ['d'], 'c': ['d'], 'd': [], 'x': []})
+    assert sorted(dag.all_paths()) == [['a', 'b', 'd'], ['a', 'c', 'd']]
+    assert dag.all_paths('b') == [['b', 'd']]
+    assert dag.all_paths('x') == []
@@ -0,0 +1,89 @@
+import random
+
+from .. import DAG, DAGValidationError
+
+
+def snapshot(dag):
+    level_nodes = dict((level, sorted(nodes))
+                       for level, nodes in dag.level_nodes.items())
+    return dict(dag.levels), level_nodes, dag.max_level
+
+
+def assert_levels_current(dag):
+    """ Checks the incrementally maintained levels against a full rebuild. """
+
+    incremental = snapshot(dag)
+    dag.build_levels()
+    assert incremental == snapshot(dag)
+
+
+def random_dag(rng, size, density):
+    return dict((i, [j for j in range(i + 1, size) if rng.random() < density])
+                for i in range(size))
+
+
+def test_delete_edge_deepens_levels():
+    dag = DAG()
+    dag.from_dict({'a': ['b', 'c'], 'b': ['c'], 'c': []})
+    assert dag.depth('c') == 1
+
+    dag.delete_edge('a', 'c')
+    assert dag.depth('c') == 2
+    assert dag.get_nodes_at_depth(2) == ['c']
+    assert dag.max_level == 2
+
+
+def test_add_node_is_a_root():
+    dag = DAG()
+    dag.from_dict({'a': ['b'], 'b': []})
+    dag.add_node('x')
+    assert dag.depth('x') == 0
+    assert sorted(dag.get_nodes_at_depth(0)) == ['a', 'x']
+
+    dag.add_edge('b', 'x')
+    assert dag.depth('x') == 2
+    assert dag.get_nodes_at_depth(0) == ['a']
+
+
+def test_random_mutations_match_build_levels():
+    rng = random.Random(3)
+    for _ in range(200):
+        size = rng.randint(2, 20)
+        dag = DAG()
+        dag.from_dict(random_dag(rng, size, 0.15))
+        next_node = size
+
+        for _ in range(30):
+            nodes = list(dag.graph)
+            action = rng.random()
+            if action < 0.4 and len(nodes) > 1:
+                ind_node, dep_node = rng.sample(nodes, 2)
+                try:
+                    dag.add_edge(ind_node, dep_node)
+                except DAGValidationError:
+                    continue
+            elif action < 0.7:
+                edges = [(u, v) for u in dag.graph for v in dag.graph[u]]
+                if not edges:
+                    continue
+                dag.delete_edge(*rng.choice(edges))
+            elif action < 0.85:
+                dag.add_node(next_node)
+                next_node += 1
+            elif len(nodes) > 1:
+                dag.delete_node(rng.choice(nodes))
+            assert_levels_current(dag)
+
+
+def test_upstream_follows_levels():
+    rng = random.Random(11)
+    for _ in range(100):
+        size = rng.randint(2, 20)
+        dag = DAG()
+        dag.from_dict(random_dag(rng, size, 0.2))
+        for node in dag.graph:
+            path = dag.upstream(node)
+            assert len(path) == dag.depth(node) + 1
+            assert not dag.predecessors(path[-1])
+            assert all(child in dag.graph[parent]
+                       for child, parent in zip(path, path[1:]))